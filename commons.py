@@ -109,6 +109,19 @@ def subsequent_mask(length):
   return mask
 
 
+def is_compiling():
+  """True while torch.compile is tracing; always False on torch without torch.compiler.is_compiling."""
+  compiler = getattr(torch, 'compiler', None)
+  return compiler is not None and hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+
+def upcast_half(x):
+  """Cast fp16/bf16 tensors to fp32; other dtypes (e.g. fp64) are returned unchanged."""
+  if x.dtype == torch.float16 or x.dtype == torch.bfloat16:
+    return x.float()
+  return x
+
+
 @torch.jit.script
 def fused_add_tanh_sigmoid_multiply(input_a, input_b, n_channels):
   n_channels_int = n_channels[0]
@@ -277,8 +277,13 @@ class LatentEncoder(nn.Module):
 
     
 class Generator(torch.nn.Module):
-    def __init__(self, initial_channel, resblock, resblock_kernel_sizes, resblock_dilation_sizes, upsample_rates, upsample_initial_channel, upsample_kernel_sizes, gin_channels=0):
+    def __init__(self, initial_channel, resblock, resblock_kernel_sizes, resblock_dilation_sizes, upsample_rates, upsample_initial_channel, upsample_kernel_sizes, gin_channels=0, inference_dtype=None, parallel_streams=False):
         super(Generator, self).__init__()
+        if isinstance(inference_dtype, str): # e.g. "bfloat16" from a json config
+            inference_dtype = getattr(torch, inference_dtype)
+        self.inference_dtype = inference_dtype
+        self.parallel_streams = parallel_streams # opt-in until benchmarked on GPU, see _resblocks_on_streams
+        self._streams = {} # device -> side streams, created lazily on first use
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
         self.conv_pre = nn.Conv1d(initial_channel, upsample_initial_channel, 7, 1, padding=3)
@@ -303,6 +308,14 @@ class Generator(torch.nn.Module):
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
 
     def forward(self, x, g=None):
+        # training runs under the caller's own autocast, so only switch precision in eval mode
+        if self.inference_dtype is not None and not self.training:
+            with torch.autocast(device_type=x.device.type, dtype=self.inference_dtype):
+                o = self._forward(x, g=g)
+            return o.to(x.dtype)
+        return self._forward(x, g=g)
+
+    def _forward(self, x, g=None):
         x = self.conv_pre(x)
         if g is not None:
             x = x + self.cond(g)
@@ -310,12 +323,16 @@ class Generator(torch.nn.Module):
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
             x = self.ups[i](x)
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x)
-                else:
-                    xs += self.resblocks[i*self.num_kernels+j](x)
+            if (self.parallel_streams and x.is_cuda and not self.training and self.num_kernels > 1
+                    and not torch.jit.is_tracing() and not commons.is_compiling()):
+                xs = self._resblocks_on_streams(i, x)
+            else:
+                xs = None
+                for j in range(self.num_kernels):
+                    if xs is None:
+                        xs = self.resblocks[i*self.num_kernels+j](x)
+                    else:
+                        xs += self.resblocks[i*self.num_kernels+j](x)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -323,6 +340,24 @@ class Generator(torch.nn.Module):
 
         return x
 
+    def _resblocks_on_streams(self, i, x):
+        """The resblocks of one upsample stage all read the same x, so run each on its own stream"""
+        main = torch.cuda.current_stream(x.device)
+        if x.device not in self._streams: # keyed by device so .to(other_device) gets its own streams
+            self._streams[x.device] = [torch.cuda.Stream(device=x.device) for _ in range(self.num_kernels)]
+        streams = self._streams[x.device]
+        outs = []
+        for j, s in enumerate(streams):
+            s.wait_stream(main)
+            with torch.cuda.stream(s):
+                outs.append(self.resblocks[i*self.num_kernels+j](x))
+        xs = None
+        for o, s in zip(outs, streams):
+            main.wait_stream(s)
+            o.record_stream(main) # o was allocated on s but is consumed on main
+            xs = o if xs is None else xs + o
+        return xs
+
     def remove_weight_norm(self):
         print('Removing weight norm...')
         for l in self.ups:
@@ -330,6 +365,11 @@ class Generator(torch.nn.Module):
         for l in self.resblocks:
             l.remove_weight_norm()
 
+    def fuse_for_inference(self):
+        """Fold weight_norm into the conv weights (inference only, not reversible)"""
+        if hasattr(self.ups[0], 'weight_g'):
+            self.remove_weight_norm()
+
 
 class DiscriminatorP(torch.nn.Module):
     def __init__(self, period, kernel_size=5, stride=3, use_spectral_norm=False):
@@ -535,6 +575,8 @@ class Decoder(nn.Module):
         upsample_kernel_sizes, 
         n_speakers, 
         gin_channels, 
+        inference_dtype=None, 
+        parallel_streams=False, 
         **kwargs):
         super(Decoder, self).__init__()
         self.n_speakers = n_speakers
@@ -547,7 +589,9 @@ class Decoder(nn.Module):
             upsample_rates=upsample_rates, 
             upsample_initial_channel=upsample_initial_channel, 
             upsample_kernel_sizes=upsample_kernel_sizes, 
-            gin_channels=gin_channels
+            gin_channels=gin_channels, 
+            inference_dtype=inference_dtype, 
+            parallel_streams=parallel_streams
         )
         
     def forward(self, z, g=None):
@@ -555,3 +599,6 @@ class Decoder(nn.Module):
             g = None
         o_hat = self.generator(z, g=g)
         return o_hat
+
+    def fuse_for_inference(self):
+        self.generator.fuse_for_inference()
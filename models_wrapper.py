@@ -1,6 +1,8 @@
 from tokenize import Token
 from text import symbols,  text_to_sequence
 from models import Encoder, Decoder
+from modules import ConvFlow
+from transforms import piecewise_rational_quadratic_transform
 import commons
 import utils
 
@@ -16,9 +18,33 @@ def to_device(tensor):
     return tensor.to(_device)
 
 
+def setup_cuda_backends():
+    """Enable cuDNN autotuning and TF32 when inferring on a GPU.
+    These flags are process-wide: they apply to every CUDA conv/matmul in this process.
+    benchmark autotunes per input shape, so the first call at each new sequence length
+    is slow; bucket or pad lengths for steady latency."""
+    if _device.type != 'cuda':
+        return
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+
+
+def freeze_for_inference(model, example_inputs):
+    """Trace, freeze and warm up `model`; weight_norm must already be folded"""
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_inputs)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        frozen(*example_inputs) # the first call runs the JIT optimization passes
+    return frozen
+
+
 class EncoderWrapper(nn.Module):
-    def __init__(self, checkpoint_path, hps_path):
+    def __init__(self, checkpoint_path, hps_path, jit=False, compile_mode=None):
         super(EncoderWrapper, self).__init__()
+        assert not (jit and compile_mode), "use either jit or compile_mode, not both"
+        setup_cuda_backends()
         hps = utils.get_hparams_from_file(hps_path)
         self.hps = hps
         self.encoder = Encoder(
@@ -27,6 +53,19 @@ class EncoderWrapper(nn.Module):
             n_speakers=hps.data.n_speakers, 
             **hps.model).to(_device)
         _ = utils.load_checkpoint(checkpoint_path, self.encoder, None)
+        if jit:
+            # the residual stacks are scriptable; the rest of infer() samples durations and stays eager
+            for net in (self.encoder.text_encoder, self.encoder.latent_encoder):
+                net.res_blocks = torch.jit.freeze(torch.jit.script(net.res_blocks.eval()))
+        if compile_mode is not None:
+            # the flow spline's boolean-mask indexing and domain check are data dependent;
+            # run it eagerly, outside the graph, instead of breaking or recompiling on every call
+            spline = torch.compiler.disable(piecewise_rational_quadratic_transform)
+            for m in self.encoder.modules():
+                if isinstance(m, ConvFlow):
+                    m.spline_transform = spline
+            # dynamic=True: text and mel lengths vary per call, don't recompile for each one
+            self.encoder.infer = torch.compile(self.encoder.infer, mode=compile_mode, dynamic=True)
         
     def forward(self, x, x_lengths, sid=None): 
         x, x_lengths = to_device(x), to_device(x_lengths)
@@ -38,19 +77,39 @@ class EncoderWrapper(nn.Module):
         
         
 class DecoderWrapper(nn.Module):
-    def __init__(self, checkpoint_path, hps_path):
+    def __init__(self, checkpoint_path, hps_path, jit=False, compile_mode=None):
         super(DecoderWrapper, self).__init__()
+        assert not (jit and compile_mode), "use either jit or compile_mode, not both"
+        setup_cuda_backends()
         hps = utils.get_hparams_from_file(hps_path)
         self.hps = hps
         self.decoder = Decoder(
             n_speakers=hps.data.n_speakers, **hps.model).to(_device)
         _ = utils.load_checkpoint(checkpoint_path, self.decoder, None)
+        self.decoder.eval()
+        self.decoder.fuse_for_inference()
+        self.traced_with_g = None # None: eager module, else whether the traced signature takes g
+        if jit:
+            # zeros, not randn: building the session must not consume the caller's RNG
+            example_inputs = (to_device(torch.zeros(1, hps.model.inter_channels, 64)),)
+            if hps.data.n_speakers > 0:
+                example_inputs += (to_device(torch.zeros(1, hps.model.gin_channels, 1)),)
+            self.decoder = freeze_for_inference(self.decoder, example_inputs)
+            self.traced_with_g = len(example_inputs) == 2
+        if compile_mode is not None:
+            self.decoder = torch.compile(self.decoder, mode=compile_mode, dynamic=True)
         
     def forward(self, z, g=None):
         z = to_device(z)
         self.decoder.eval()
         with torch.no_grad():
-            o_hat = self.decoder(z, g=g)
+            if self.traced_with_g is None:
+                o_hat = self.decoder(z, g=g)
+            elif self.traced_with_g:
+                assert g is not None, "the traced multi-speaker decoder requires g"
+                o_hat = self.decoder(z, g)
+            else:
+                o_hat = self.decoder(z) # single-speaker Decoder ignores g
         return o_hat
     
     
@@ -76,18 +135,20 @@ class Tokenizer(object):
     
     
 class NixttsTorchSession(object):
-    def __init__(self, enc_ckpt_path, dec_ckpt_path, enc_hps_path, dec_hps_path):
+    def __init__(self, enc_ckpt_path, dec_ckpt_path, enc_hps_path, dec_hps_path, jit=False, compile_mode=None):
         self.enc_hps_path = enc_hps_path
         self.dec_hps_path = dec_hps_path
         self.enc_ckpt_path = enc_ckpt_path
         self.dec_ckpt_path = dec_ckpt_path
+        self.jit = jit
+        self.compile_mode = compile_mode
         self.initialize()
         
     def initialize(self):
         self.encoder_wrapper = EncoderWrapper(
-            self.enc_ckpt_path, self.enc_hps_path)
+            self.enc_ckpt_path, self.enc_hps_path, jit=self.jit, compile_mode=self.compile_mode)
         self.decoder_wrapper = DecoderWrapper(
-            self.dec_ckpt_path, self.dec_hps_path)
+            self.dec_ckpt_path, self.dec_hps_path, jit=self.jit, compile_mode=self.compile_mode)
         self.tokenizer = Tokenizer(self.encoder_wrapper.hps)
         
     def __call__(self, text, sid=0):
@@ -1,10 +1,15 @@
 from transforms import piecewise_rational_quadratic_transform
-from commons import get_padding, init_weights
+from commons import (
+    get_padding, 
+    init_weights, 
+    upcast_half, 
+)
 from torch.nn.utils import weight_norm, remove_weight_norm
 import torch.nn.functional as F
 import torch.nn as nn
 import torch
 import math
+from typing import Optional
 
 LRELU_SLOPE = 0.1
 
@@ -14,27 +19,29 @@ class LayerNorm(nn.LayerNorm):
         super(LayerNorm, self).__init__(normalized_shape, eps=eps, elementwise_affine=elementwise_affine)
 
     def forward(self, x):
-        return super().forward(x.transpose(1,2)).transpose(1,2)
+        # normalize over channels of [b, c, t]; the native kernel on the transposed view is
+        # faster on CPU than a hand-written reduction over dim 1
+        return F.layer_norm(x.transpose(1, 2), self.normalized_shape, self.weight, self.bias, self.eps).transpose(1, 2)
 
             
 class PositionalEncoding(nn.Module):
     def __init__(self, max_len, d_model):
         super(PositionalEncoding,self).__init__()
         
-        self.encoding = torch.zeros(max_len, d_model)
-        self.encoding.requires_grad = False # we don't need to compute gradient
+        encoding = torch.zeros(max_len, d_model)
         
         pos = torch.arange(0, max_len)
         pos = pos.float().unsqueeze(dim=1)
         
         _2i = torch.arange(0, d_model, step=2).float()
         
-        self.encoding[:,0::2] = torch.sin(pos/(10000**(_2i/d_model)))
-        self.encoding[:,1::2] = torch.cos(pos/(10000**(_2i/d_model)))
+        encoding[:,0::2] = torch.sin(pos/(10000**(_2i/d_model)))
+        encoding[:,1::2] = torch.cos(pos/(10000**(_2i/d_model)))
+        # non-persistent buffer: follows the module on .to()/.cuda(), not saved in checkpoints
+        self.register_buffer('encoding', encoding, persistent=False)
         
-    def forward(self,x):
-        batch_size, seq_len = x.size()
-        self.encoding = self.encoding.to(device=x.device)
+    def forward(self, x):
+        seq_len = x.size(1)
         return self.encoding[:seq_len,:]
 
 
@@ -43,22 +50,17 @@ class TextResidualBlock(nn.Module):
 
     def __init__(self, channels, kernel_size, dilation,  n=2):
         super(TextResidualBlock, self).__init__()
-        self.blocks = [
+        self.blocks = nn.Sequential(*[
             nn.Sequential(
                 DDSConv(channels, kernel_size, 3),
                 torch.nn.SiLU(),
                 LayerNorm(channels)
             )
             for i in range(n)
-        ]
-        self.blocks = nn.ModuleList(self.blocks)
+        ])
 
     def forward(self, x):
-        inputs = x
-        for layer in self.blocks:
-            x = layer(x)
-        x = x + inputs
-        return x 
+        return self.blocks(x) + x
     
     
 class LinearNorm(nn.Module):
@@ -114,11 +116,12 @@ class ConvNorm(nn.Module):
         self.transpose = transpose
 
     def forward(self, x):
+        # conv copies a non-contiguous input itself; an explicit .contiguous() would add a second copy
         if self.transpose:
-            x = x.contiguous().transpose(1, 2)
+            x = x.transpose(1, 2)
         x = self.conv(x)
         if self.transpose:
-            x = x.contiguous().transpose(1, 2)
+            x = x.transpose(1, 2)
 
         return x
     
@@ -166,6 +169,11 @@ class ResBlock1(torch.nn.Module):
             remove_weight_norm(l)
         for l in self.convs2:
             remove_weight_norm(l)
+
+    def fuse_for_inference(self):
+        """Fold the weight_norm reparametrization into plain conv weights"""
+        if hasattr(self.convs1[0], 'weight_g'):
+            self.remove_weight_norm()
             
             
 class DSResBlock(torch.nn.Module):
@@ -175,12 +183,18 @@ class DSResBlock(torch.nn.Module):
 
     def forward(self, x, x_mask=None):
         return self.dds_conv(x, x_mask=None)
+
+    def remove_weight_norm(self):
+        pass # DDSConv is not weight-normalized
+
+    def fuse_for_inference(self):
+        pass
     
     
 class Log(nn.Module):
   def forward(self, x, x_mask, reverse=False, **kwargs):
     if not reverse:
-      y = torch.log(torch.clamp_min(x, 1e-5)) * x_mask
+      y = torch.log(torch.clamp_min(upcast_half(x), 1e-5)) * x_mask
       logdet = torch.sum(-y, [1, 2])
       return y, logdet
     else:
@@ -196,9 +210,9 @@ class ElementwiseAffine(nn.Module):
     self.logs = nn.Parameter(torch.zeros(channels,1))
 
   def forward(self, x, x_mask, reverse=False, **kwargs):
+    x = upcast_half(x) # keep the log-det in fp32 under autocast
     if not reverse:
-      y = self.m + torch.exp(self.logs) * x
-      y = y * x_mask
+      y = torch.addcmul(self.m, torch.exp(self.logs), x).mul_(x_mask)
       logdet = torch.sum(self.logs * x_mask, [1,2])
       return y, logdet
     else:
@@ -216,6 +230,10 @@ class ConvFlow(nn.Module):
     self.num_bins = num_bins
     self.tail_bound = tail_bound
     self.half_channels = in_channels // 2
+    self._split_sizes = [self.half_channels] * 2
+    self._inv_sqrt_fc = 1.0 / math.sqrt(filter_channels)
+    # EncoderWrapper swaps in a torch.compiler.disable'd copy when compiling
+    self.spline_transform = piecewise_rational_quadratic_transform
 
     self.pre = nn.Conv1d(self.half_channels, filter_channels, 1)
     self.convs = DDSConv(filter_channels, kernel_size, n_layers, p_dropout=0.)
@@ -224,28 +242,30 @@ class ConvFlow(nn.Module):
     self.proj.bias.data.zero_()
 
   def forward(self, x, x_mask, g=None, reverse=False):
-    x0, x1 = torch.split(x, [self.half_channels]*2, 1)
+    x0, x1 = torch.split(x, self._split_sizes, 1)
     h = self.pre(x0)
     h = self.convs(h, x_mask, g=g)
     h = self.proj(h) * x_mask
 
     b, c, t = x0.shape
-    h = h.reshape(b, c, -1, t).permute(0, 1, 3, 2) # [b, cx?, t] -> [b, c, t, ?]
-
-    unnormalized_widths = h[..., :self.num_bins] / math.sqrt(self.filter_channels)
-    unnormalized_heights = h[..., self.num_bins:2*self.num_bins] / math.sqrt(self.filter_channels)
-    unnormalized_derivatives = h[..., 2 * self.num_bins:]
-
-    x1, logabsdet = piecewise_rational_quadratic_transform(x1,
-        unnormalized_widths,
-        unnormalized_heights,
-        unnormalized_derivatives,
+    h = h.view(b, c, -1, t) # [b, cx?, t] -> [b, c, ?, t]
+
+    unnormalized_widths = h[:, :, :self.num_bins] * self._inv_sqrt_fc
+    unnormalized_heights = h[:, :, self.num_bins:2*self.num_bins] * self._inv_sqrt_fc
+    unnormalized_derivatives = h[:, :, 2 * self.num_bins:]
+
+    # the spline wants bins last ([b, c, t, ?]); movedim is only a view.
+    # it is numerically sensitive, so always evaluate it in fp32
+    x1, logabsdet = self.spline_transform(upcast_half(x1),
+        upcast_half(unnormalized_widths.movedim(2, -1)),
+        upcast_half(unnormalized_heights.movedim(2, -1)),
+        upcast_half(unnormalized_derivatives.movedim(2, -1)),
         inverse=reverse,
         tails='linear',
         tail_bound=self.tail_bound
     )
 
-    x = torch.cat([x0, x1], 1) * x_mask
+    x = torch.cat([x0, x1], 1).mul_(x_mask)
     logdet = torch.sum(logabsdet * x_mask, [1,2])
     if not reverse:
         return x, logdet
@@ -257,7 +277,7 @@ class Flip(nn.Module):
   def forward(self, x, *args, reverse=False, **kwargs):
     x = torch.flip(x, [1])
     if not reverse:
-      logdet = torch.zeros(x.size(0)).to(dtype=x.dtype, device=x.device)
+      logdet = torch.zeros(x.size(0), dtype=x.dtype, device=x.device)
       return x, logdet
     else:
       return x
@@ -288,20 +308,28 @@ class DDSConv(nn.Module):
       self.norms_1.append(LayerNorm(channels))
       self.norms_2.append(LayerNorm(channels))
 
-  def forward(self, x, x_mask=None, g=None):
+  def forward(self, x, x_mask: Optional[torch.Tensor] = None, g: Optional[torch.Tensor] = None):
+    # at inference, reuse x's storage once it is no longer the caller's tensor
+    inplace = not (self.training or torch.is_grad_enabled())
+    owned = False
     if g is not None:
       x = x + g
-    for i in range(self.n_layers):
-      if x_mask is not None:
-        x = x * x_mask
-      y = self.convs_sep[i](x)
-      y = self.norms_1[i](y)
-      y = F.gelu(y)
-      y = self.convs_1x1[i](y)
-      y = self.norms_2[i](y)
-      y = F.gelu(y)
+      owned = True
+    # x_mask is binary, so x only needs masking on entry and after each residual add
+    if x_mask is not None:
+      x = x * x_mask
+      owned = True
+    for conv_sep, conv_1x1, norm_1, norm_2 in zip(self.convs_sep, self.convs_1x1, self.norms_1, self.norms_2):
+      y = conv_sep(x)
+      y = F.gelu(norm_1(y))
+      y = conv_1x1(y)
+      y = F.gelu(norm_2(y))
       y = self.drop(y)
-      x = x + y
+      if inplace and owned:
+        x = x.add_(y)
+      else:
+        x = x + y
+        owned = True
       if x_mask is not None:
-        x = x * x_mask
+        x = x.mul_(x_mask) if inplace else x * x_mask
     return x 